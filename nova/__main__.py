@@ -1,6 +1,7 @@
 # Copyright (c) 2024-2025 iiPython
 
 # Modules
+import os
 import tomllib
 import asyncio
 from pathlib import Path
@@ -37,31 +38,41 @@ if config_file.is_file():
         Path(mapping[0]).absolute(),
         Path(mapping[1]).absolute(),
         config["project"].get("build-exclude") or [],
-        config["project"].get("after_build_command")
+        config["project"].get("after_build_command"),
+        config["project"].get("jobs", 1),
+        Path(config["project"].get("cache", ".nova/cache")).absolute()
     )
 
     # Initialize plugins
-    active_plugins = [fetch_plugin("static")(builder, {})]  # type: ignore
-    for plugin, config in config.get("plugins", {}).items():
+    plugins = config.get("plugins", {})
+    active_plugins = [fetch_plugin("static")(builder, plugins.pop("static", {}))]  # type: ignore
+    for plugin, config in plugins.items():
         active_plugins.append(fetch_plugin(plugin)(builder, config))  # type: ignore
 
     builder.register_plugins(active_plugins)
 
     # Link up config-needing commands
     @nova.command()
-    def build() -> None:
+    @click.option("--full", is_flag = True, help = "Rebuilds every page, ignoring the previous build state.")
+    @click.option("--jobs", "-j", type = int, help = "Number of processes to render with, 0 uses every core.")
+    def build(full: bool, jobs: int | None) -> None:
         """Builds your app into servable HTML."""
-        rcon.print(f"[green]\u2713 App built in [b]{builder.wrapped_build()}ms[/]![/]")
+        if jobs is not None:
+            builder.jobs = jobs or os.cpu_count() or 1
+
+        rcon.print(f"[green]\u2713 App built in [b]{builder.wrapped_build(full = full)}ms[/]![/]")
+        rcon.print(f"[dim]  {len(builder.written)} file(s) written, {len(builder.skipped - builder.written)} unchanged.[/]")
 
     @nova.command()
     @click.option("--host", default = "127.0.0.1", help = "Set the host to run on, defaults to 127.0.0.1.")
     @click.option("--port", default = 8000, type = int, help = "Set the port to bind to, defaults to 8000.")
     @click.option("--reload", is_flag = True, help = "Enables Nova's hot-reloading feature.")
     @click.option("--open", is_flag = True, help = "Automatically opens the web server in your default browser.")
-    def serve(host: str, port: int, reload: bool, open: bool) -> None:
+    @click.option("--debounce", default = 100, type = int, help = "Milliseconds to wait for changes to settle before rebuilding, defaults to 100.")
+    def serve(host: str, port: int, reload: bool, open: bool, debounce: int) -> None:
         """Launches a local development server with the built app."""
         from nova.internal.stack import Stack
-        asyncio.run(Stack(host, port, reload, open, builder).start())
+        asyncio.run(Stack(host, port, reload, open, builder, debounce).start())
 
 else:
 
@@ -0,0 +1,23 @@
+// Copyright (c) 2025 iiPython
+// Long-running minification worker, reads one JSON request per line and answers in order.
+const readline = require("readline");
+const tools = {};
+for (const [name, directory] of Object.entries(JSON.parse(process.argv[2]))) {
+    tools[name] = require(require.resolve(name === "uglifyjs" ? "uglify-js" : name, { paths: [directory] }));
+}
+const minify = {
+    uglifyjs: (code) => {
+        const result = tools.uglifyjs.minify(code, { toplevel: true, compress: {}, mangle: {} });
+        if (result.error) throw result.error;
+        return result.code;
+    },
+    csso: (code) => tools.csso.minify(code).css
+};
+readline.createInterface({ input: process.stdin }).on("line", (line) => {
+    const request = JSON.parse(line);
+    try {
+        process.stdout.write(JSON.stringify({ code: minify[request.tool](request.code) }) + "\n");
+    } catch (e) {
+        process.stdout.write(JSON.stringify({ error: String(e) }) + "\n");
+    }
+});
@@ -0,0 +1,37 @@
+// Copyright (c) 2025 iiPython
+(() => {
+    const matches = (url, path) => {
+        const target = new URL(url, location.href);
+        return target.origin === location.origin && target.pathname === path;
+    };
+    const bust = (url, version) => {
+        const target = new URL(url, location.href);
+        target.searchParams.set("v", version);
+        return target.href;
+    };
+    (new WebSocket(`ws://${location.host}/_nova`)).addEventListener("message", (e) => {
+        const message = JSON.parse(e.data);
+        switch (message.type) {
+            case "css-update":
+                for (const link of document.querySelectorAll("link[rel=stylesheet][href]")) {
+                    if (!matches(link.href, message.path)) continue;
+
+                    // Keep the old stylesheet around until the new one loads, otherwise the page flashes
+                    const clone = link.cloneNode();
+                    clone.href = bust(link.href, message.version);
+                    clone.addEventListener("load", () => link.remove(), { once: true });
+                    link.after(clone);
+                }
+                break;
+
+            case "asset-update":
+                for (const element of document.querySelectorAll("img[src], source[src], video[src], audio[src]")) {
+                    if (matches(element.src, message.path)) element.src = bust(element.src, message.version);
+                }
+                break;
+
+            case "page-reload":
+                if (message.paths.includes(location.pathname)) location.reload();
+        }
+    });
+})();
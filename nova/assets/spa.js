@@ -1,24 +1,68 @@
 // Copyright (c) 2024 iiPython
 (() => {
     const pages = [%s];
+    const [prefetch, cache_size] = [%s, %s];
+    const manifest = fetch("%s", { cache: "no-cache" }).then((response) => response.json());
     const length = location.origin.length;
-    const cache = {};
+    const cache = new Map();
     const replace = document.querySelector("%s");
+    function fetch_page(relative) {
+        if (cache.has(relative)) {
+            const page = cache.get(relative);
+            cache.delete(relative);
+            cache.set(relative, page);
+            return page;
+        }
+
+        // Store the pending request, so hovering and clicking only ever fetch once
+        const page = manifest.then(({ routes }) => {
+            if (!routes[relative]) throw new Error(`${relative} is not in the manifest`);
+            return fetch(routes[relative].fragment);
+        }).then((response) => {
+
+            // Sessions outlive deploys, the fragment this session knows about could be gone by now
+            if (!response.ok) throw new Error(`${relative} failed to load (${response.status})`);
+            return response.text();
+        });
+        page.catch(() => cache.delete(relative));
+        cache.set(relative, page);
+        if (cache.size > cache_size) cache.delete(cache.keys().next().value);
+        return page;
+    }
+    const save_data = navigator.connection && navigator.connection.saveData;
+    const observer = prefetch === "viewport" && !save_data && "IntersectionObserver" in window && new IntersectionObserver((entries) => {
+        for (const entry of entries) {
+            if (!entry.isIntersecting) continue;
+            observer.unobserve(entry.target);
+            fetch_page(entry.target.href.slice(length));
+        }
+    });
     function setup_links(element) {
         for (const link of element.getElementsByTagName("a")) {
             const relative = link.href.slice(length);
             if (!pages.includes(relative)) continue;
+            if (prefetch === "hover" && !save_data) {
+                link.addEventListener("mouseenter", () => fetch_page(relative));
+                link.addEventListener("touchstart", () => fetch_page(relative), { passive: true });
+            }
+            if (observer) observer.observe(link);
             link.addEventListener("click", async (e) => {
                 e.preventDefault();
-                if (!cache[relative]) cache[relative] = await (await fetch(`/pages${relative === '/' ? '/index' : relative}`)).text();
-                const title = relative.slice(1);
-                document.title = `%s${title && ('%s' + title[0].toUpperCase() + title.slice(1))}`;
+                let content;
+                try {
+                    content = await fetch_page(relative);
+                    document.title = (await manifest).routes[relative].title;
+                } catch {
+                    location.href = relative;  // Let the browser load it the normal way instead
+                    return;
+                }
                 replace.innerHTML = "";
-                replace.append(document.createRange().createContextualFragment(cache[relative]));
+                replace.append(document.createRange().createContextualFragment(content));
                 history.pushState(null, document.title, relative);
                 setup_links(replace);
             });
         }
     }
     setup_links(document);
-})();
\ No newline at end of file
+    if (prefetch === "idle" && !save_data) (window.requestIdleCallback || setTimeout)(() => manifest.then(({ popular }) => popular.forEach(fetch_page)));
+})();
@@ -2,96 +2,529 @@
 
 # Modules
 import os
-import re
+import json
 import time
 import shlex
 import typing
+import hashlib
+import itertools
 import subprocess
 from pathlib import Path
+from threading import Event
+from collections import deque
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+from concurrent.futures import Future, ProcessPoolExecutor
 
+import jinja2
 from jinja2 import Environment, FileSystemLoader, select_autoescape
+from jinja2.bccache import Bucket, FileSystemBytecodeCache
+
+from nova import __version__
+
+# Initialization
+reload_js = (Path(__file__).parents[1] / "assets/reload.js").read_text("utf8")
+content_encodings = [("br", ".br"), ("gzip", ".gz")]  # Precompressed copies sitting next to an output
+
+# Raised when a newer build has made the current one pointless
+class BuildInterrupted(Exception):
+    pass
 
 # Handle loading plugins in the correct order
-plugin_load_order = ["static", "sass", "typescript", "spa", "nonce", "minify"]
+plugin_load_order = ["static", "sass", "typescript", "spa", "nonce", "minify", "compress"]
+
+# Dependency tracking
+class TrackingLoader(FileSystemLoader):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.loaded = set()
+
+    def get_source(self, environment: Environment, template: str) -> tuple[str, str, typing.Callable[[], bool]]:
+        self.loaded.add(template)
+        contents, filename, uptodate = super().get_source(environment, template)
+
+        # Cached templates only ever hit the uptodate check, so track that as well
+        def tracked_uptodate() -> bool:
+            self.loaded.add(template)
+            return uptodate()
+
+        return contents, filename, tracked_uptodate
+
+class ReferenceParser(HTMLParser):
+    attributes = {"link": "href", "script": "src", "img": "src", "source": "src"}
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.references = []
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        if tag not in self.attributes:
+            return
+
+        value = dict(attrs).get(self.attributes[tag])
+        if value and not urlsplit(value).scheme and not value.startswith("//"):
+            self.references.append(urlsplit(value).path)
+
+# Cache handling
+def prune_cache(directory: Path, max_size: int, prefix: str = "") -> None:
+    entries = []
+    for file in directory.iterdir():
+        if not file.name.startswith(prefix):
+            file.unlink(missing_ok = True)
+            continue
+
+        entries.append((file.stat(), file))
+
+    # Evict the least recently used entries until we're back under the limit
+    total = sum(stat.st_size for stat, _ in entries)
+    for stat, file in sorted(entries, key = lambda entry: entry[0].st_mtime):
+        if total <= max_size:
+            break
+
+        file.unlink(missing_ok = True)
+        total -= stat.st_size
+
+# Compiled template caching
+class BytecodeCache(FileSystemBytecodeCache):
+    def __init__(self, directory: Path, max_size: int = 64 * 1024 ** 2) -> None:
+        directory.mkdir(parents = True, exist_ok = True)
+
+        # Bumping either version leaves the old entries behind for pruning
+        self.prefix = f"nova-{__version__}-jinja2-{jinja2.__version__}-"
+        super().__init__(str(directory), f"{self.prefix}%s.cache")
+        self.directory, self.max_size = directory, max_size
+
+    def get_bucket(self, environment: Environment, name: str, filename: typing.Optional[str], source: str) -> Bucket:
+        key = hashlib.sha1(f"{name}\0{source}".encode()).hexdigest()
+        bucket = Bucket(environment, key, self.get_source_checksum(source))
+        self.load_bytecode(bucket)
+        return bucket
+
+    def load_bytecode(self, bucket: Bucket) -> None:
+        super().load_bytecode(bucket)
+        if bucket.code is not None:
+            os.utime(self._get_cache_filename(bucket))
+
+    def prune(self) -> None:
+        prune_cache(self.directory, self.max_size, self.prefix)
+
+class BuildState:
+    def __init__(self, source: Path, destination: Path) -> None:
+        self.source, self.destination = source, destination
+        self.location = destination / ".nova-state.json"
+
+        self.fingerprint, self.pages, self.templates, self.outputs = None, {}, {}, {}
+        if self.location.is_file():
+            try:
+                state = json.loads(self.location.read_text("utf8"))
+                self.fingerprint, self.pages, self.templates, self.outputs = \
+                    state["fingerprint"], state["pages"], state["templates"], state["outputs"]
+
+            except (ValueError, KeyError):
+                pass
+
+        self._current, self.changed = {}, None
+
+    def set_changes(self, changed: typing.Optional[set[str]]) -> None:
+        self._current, self.changed = {}, changed
+
+    def snapshot(self, template: str) -> list | None:
+
+        # When we know exactly what changed, there's no need to look at anything else
+        if self.changed is not None and template not in self.changed and template in self.templates:
+            return self.templates[template]
+
+        if template not in self._current:
+            known, path = self.templates.get(template), self.source / template
+            try:
+                mtime = path.stat().st_mtime_ns
+                if known is None or known[0] != mtime:
+                    known = [mtime, hashlib.sha1(path.read_bytes()).hexdigest()]
+
+            except OSError:
+                known = None
+
+            self._current[template] = known
+
+        return self._current[template]
+
+    def is_stale(self, page: str) -> bool:
+        if page not in self.pages:
+            return True
+
+        for template in self.pages[page]["templates"]:
+            if template not in self.templates:
+                return True
+
+            previous, current = self.templates[template], self.snapshot(template)
+            if (previous and previous[1]) != (current and current[1]):
+                return True
+
+        return False
+
+    def record(self, page: str, templates: set[str], references: list[str], digest: str) -> None:
+        self.pages[page] = {"templates": sorted(templates), "references": references, "digest": digest}
+        for template in templates:
+            self.snapshot(template)
+
+    def is_unchanged(self, path: Path, content: str | bytes) -> bool:
+        data = content.encode("utf8") if isinstance(content, str) else content
+        known = self.outputs.get(str(path.relative_to(self.destination)))
+        return known is not None and known[1] == hashlib.sha1(data).hexdigest() and not self.is_dirty(path)
+
+    def write(self, path: Path, content: str | bytes) -> bool:
+        data = content.encode("utf8") if isinstance(content, str) else content
+
+        # Skip the write if the file on disk is still the one we wrote last time
+        if self.is_unchanged(path, data):
+            return False
+
+        path.write_bytes(data)
+        self.outputs[str(path.relative_to(self.destination))] = [path.stat().st_mtime_ns, hashlib.sha1(data).hexdigest()]
+        return True
+
+    def is_dirty(self, path: Path) -> bool:
+        known = self.outputs.get(str(path.relative_to(self.destination)))
+        try:
+            return known is None or path.stat().st_mtime_ns != known[0]
+
+        except OSError:
+            return True
+
+    def save(self, fingerprint: str) -> None:
+        self.fingerprint = fingerprint
+        self.templates = {
+            template: self.snapshot(template)
+            for page in self.pages.values() for template in page["templates"]
+        }
+        self.location.write_text(json.dumps({
+            "fingerprint": self.fingerprint,
+            "pages": self.pages,
+            "templates": self.templates,
+            "outputs": self.outputs
+        }))
+        self._current = {}
 
 # Main class
 class NovaBuilder:
-    def __init__(self, source: Path, destination: Path, build_exclude: list[str], after_build_command: typing.Optional[str]) -> None:
+    def __init__(
+        self,
+        source: Path,
+        destination: Path,
+        build_exclude: list[str],
+        after_build_command: typing.Optional[str],
+        jobs: int = 1,
+        cache: typing.Optional[Path] = None
+    ) -> None:
         self.source, self.destination = source, destination
         self.destination.mkdir(exist_ok = True)
 
-        self.build_exclude = build_exclude
+        # Handle parallel rendering
+        self.jobs = jobs or os.cpu_count() or 1
+        self._pool = None
+
+        self.build_exclude, self.page_suffixes = build_exclude, (".html", ".j2", ".jinja", ".jinja2")
         self.after_build_command = after_build_command if (after_build_command or "").strip() else None
 
         # Create Jinja2 environment
+        self.cache = cache
+        self.loader = TrackingLoader(source)
+        self.bytecode_cache = BytecodeCache(cache / "jinja2") if cache is not None else None
         self.environ = Environment(
-            loader = FileSystemLoader(source),
-            autoescape = select_autoescape()
+            loader = self.loader,
+            autoescape = select_autoescape(),
+            bytecode_cache = self.bytecode_cache
         )
 
         # Initial variable setup
-        self.plugins = {}
-        self.file_assocs, self.build_dependencies = {}, {}
-
-        # Regex
-        self._rgx_jinja = re.compile(r"{% \w* [\"'](\w.+)[\"'][\w ]* %}")
-        self._rgx_reference = re.compile(r"<(?:link|script).* (?:href|src) ?= ?[\"']([\w/.]+)[\"'].*>")
+        self.plugins, self.stages, self.pages = {}, [], []
+        self.file_assocs, self.build_dependencies, self.dependents = {}, {}, {}
+        self.sources: typing.Optional[set[str]] = None
+        self.rendered, self.processed, self.written, self.skipped, self.removed = set(), set(), set(), set(), set()
+        self.state = BuildState(source, destination)
+        self.interrupt = Event()
 
     def register_plugins(self, plugins: list) -> None:
         self.plugins |= {type(plugin).__name__: plugin for plugin in plugins}
 
     def wrapped_build(self, *args, **kwargs) -> float:
         start = time.time()
-        self.perform_build(*args, **kwargs)
+        try:
+            self.perform_build(*args, **kwargs)
+
+        except Exception:
+
+            # Pages recorded in memory might never have been written (ie. still waiting on a deferred stage),
+            # so the next build goes off of the last state that actually made it to disk
+            self.state = BuildState(self.source, self.destination)
+            raise
+
         return round((time.time() - start) * 1000, 2)
 
+    def is_page(self, file: Path) -> bool:
+        return file.suffix in self.page_suffixes and file.relative_to(self.source).parts[0] not in self.build_exclude
+
+    def expand_changes(self, changes: set[Path]) -> set[Path]:
+        expanded = set()
+        for change in changes:
+
+            # Moving a directory around (ie. mv or a git checkout) only reports the directory itself
+            if change.is_dir():
+                expanded |= {file for file in change.rglob("*") if file.is_file()}
+
+            elif not change.exists() and change.is_relative_to(self.source):
+                prefix = f"{change.relative_to(self.source).as_posix()}/"
+                expanded |= {change} | {self.source / file for file in self.sources or [] if file.startswith(prefix)}
+
+            else:
+                expanded.add(change)
+
+        for file in expanded:
+            if file.is_relative_to(self.source):
+                (self.sources.add if file.is_file() else self.sources.discard)(file.relative_to(self.source).as_posix())  # type: ignore
+
+        return expanded
+
+    def calculate_fingerprint(self, include_hot_reload: bool) -> str:
+        return hashlib.sha1(json.dumps([
+            __version__,
+            include_hot_reload,
+            {name: getattr(plugin, "config", None) for name, plugin in self.plugins.items()}
+        ], sort_keys = True, default = str).encode()).hexdigest()
+
     def perform_build(
         self,
-        include_hot_reload: bool = False
+        include_hot_reload: bool = False,
+        full: bool = False,
+        changes: typing.Optional[set[Path]] = None
     ) -> None:
-        for file in self.source.rglob("*"):
-            if not (
-                file.is_file() and
-                file.suffix in [".html", ".j2", ".jinja", ".jinja2"] and
-                file.relative_to(self.source).parts[0] not in self.build_exclude
-            ):
-                continue
+        self.changes = changes  # Absolute paths reported by the watcher, None if unknown
+        if changes is None or self.sources is None:
+            self.sources = {file.relative_to(self.source).as_posix() for file in self.source.rglob("*") if file.is_file()}
 
-            relative_location = file.relative_to(self.source)
-            destination_location = self.destination / relative_location.with_suffix(".html")
-            destination_location.parent.mkdir(exist_ok = True)
+        if changes is not None:
+            changes = self.changes = self.expand_changes(changes)
+
+        if changes is not None and self.pages:
+            pages = set(self.pages)
+            for file in changes:
+                if file.is_relative_to(self.source) and self.is_page(file):
+                    (pages.add if file.is_file() else pages.discard)(file.relative_to(self.source).as_posix())
+
+            pages = self.pages = sorted(pages)
+
+        else:
+            pages = self.pages = sorted(page for page in self.sources if self.is_page(self.source / page))
+
+        # Load the dependency graph from the last build, the previous one is still good if we know what changed
+        fingerprint = self.calculate_fingerprint(include_hot_reload)
+        if changes is None or self.state.fingerprint != fingerprint:
+            self.state = BuildState(self.source, self.destination)
 
-            # Handle hot-reloading (if enabled)
-            template_html = self.environ.get_template(str(relative_location).replace(os.sep, "/")).render(
-                relative = self.get_relative_location
+        state = self.state
+        state.set_changes(None if changes is None else {
+            file.relative_to(self.source).as_posix() for file in changes if file.is_relative_to(self.source)
+        })
+        self.rendered, self.processed, self.written, self.skipped, self.removed = set(), set(), set(), set(), set()
+        self.deferred = deque()
+        for page in set(state.pages) - set(pages):
+            self.remove(self.destination / Path(page).with_suffix(".html"))
+            del state.pages[page]
+
+        if full or state.fingerprint != fingerprint:
+            state.pages = {}
+
+        pending = {
+            page for page in pages
+            if state.is_stale(page) or not (
+                str(Path(page).with_suffix(".html")) in state.outputs if state.changed is not None
+                else (self.destination / Path(page).with_suffix(".html")).is_file()
             )
-            if include_hot_reload:
-                template_content = (self.source / relative_location).read_text("utf8")
+        }
 
-                # I said Nova was fast, never said it was W3C compliant
-                template_html += "<script>(new WebSocket(`ws://${window.location.host}/_nova`)).addEventListener(\"message\",e=>{if(JSON.parse(e.data).includes(window.location.pathname))window.location.reload();});</script>"
+        self.build_pages(sorted(pending), include_hot_reload)
 
-                # Additionally, check for any path references to keep track of
-                self.build_dependencies[relative_location] = [
-                    str(relative_location.parent / Path(dep)) if dep.startswith(".") else dep.lstrip("/")
-                    for dep in re.findall(self._rgx_reference, template_content) + \
-                        re.findall(self._rgx_jinja, template_content)
-                ]
+        # Keep track of what each page depends on for hot-reloading, only pages that just rendered can have changed
+        if include_hot_reload:
+            for page in set(self.build_dependencies) - {Path(page) for page in pages}:
+                self.track_dependencies(page, None)
 
-            # Finally, write it to the file
-            destination_location.write_text(template_html)
+            for page in pages:
+                if page in pending or Path(page) not in self.build_dependencies:
+                    self.track_dependencies(
+                        Path(page),
+                        [template for template in state.pages[page]["templates"] if template != page] + state.pages[page]["references"]
+                    )
 
         # Handle plugins
         for plugin, _ in sorted([
             (plugin, plugin_load_order.index(name.lower().removesuffix("plugin")))
-            for name, plugin in self.plugins.items()
+            for name, plugin in self.plugins.items() if hasattr(plugin, "on_build")
         ], key = lambda p: p[1]):
             plugin.on_build(include_hot_reload)
 
+        # Catch anything that was written outside of the pipeline (ie. by sass or swc), template changes can't cause that
+        scan = changes is None or any(file.suffix not in self.page_suffixes for file in changes)
+        for file in self.destination.rglob("*") if scan else []:
+            if file in self.processed or file == state.location or not self.has_stages(file, include_hot_reload):
+                continue
+
+            # Symlinks point back into the source (static files in development), never write through them
+            if file.is_symlink() or not file.is_file() or not self.is_dirty(file):
+                continue
+
+            self.process(file, file.read_text("utf8"), include_hot_reload)
+
+        self.flush()
+        state.save(fingerprint)
+        if self.bytecode_cache is not None:
+            self.bytecode_cache.prune()
+
         # Handle running additional commands
         if self.after_build_command is not None:
             subprocess.run(shlex.split(self.after_build_command))
 
+    def build_pages(self, pages: list[str], include_hot_reload: bool, force: bool = False) -> None:
+        for page, (template_html, templates, references) in zip(pages, self.render_pages(pages, include_hot_reload)):
+
+            # The in-memory build state gets thrown away on the way out, so the next build picks up where this one stopped
+            if self.interrupt.is_set():
+                raise BuildInterrupted
+
+            destination_location = self.destination / Path(page).with_suffix(".html")
+            self.rendered.add(destination_location)
+
+            # Pages that rendered to the exact same thing don't need to go through the stages again
+            digest = hashlib.sha1(template_html.encode("utf8")).hexdigest()
+            previous = self.state.pages.get(page, {}).get("digest")
+            self.state.record(page, templates, references, digest)
+            if not force and digest == previous and not self.is_dirty(destination_location):
+                self.skipped.add(destination_location)
+                continue
+
+            # Finally, run it through the plugin stages and write it to the file
+            destination_location.parent.mkdir(exist_ok = True)
+            self.process(destination_location, template_html, include_hot_reload)
+
+    def render_page(self, page: str, include_hot_reload: bool) -> tuple[str, set[str], list[str]]:
+        self.loader.loaded = set()
+        template_html = self.environ.get_template(page).render(
+            relative = self.get_relative_location
+        )
+
+        # Handle hot-reloading (if enabled)
+        references = []
+        if include_hot_reload:
+
+            # Keep track of the assets the page actually ended up referencing
+            parser = ReferenceParser()
+            parser.feed(template_html)
+            location = f"/{Path(page).with_suffix('.html').as_posix()}"
+            references = list(dict.fromkeys(urljoin(location, dep).lstrip("/") for dep in parser.references))
+
+            # I said Nova was fast, never said it was W3C compliant
+            template_html += f"<script>{reload_js}</script>"
+
+        return template_html, self.loader.loaded, references
+
+    def render_pages(self, pages: list[str], include_hot_reload: bool) -> typing.Iterable[tuple[str, set[str], list[str]]]:
+        if self.jobs < 2 or len(pages) < 2:
+            return (self.render_page(page, include_hot_reload) for page in pages)
+
+        # Hand out batches of pages to worker processes, results come back in order
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.jobs,
+                initializer = initialize_worker,
+                initargs = (self.source, self.destination, self.build_exclude, self.cache, self.file_assocs)
+            )
+
+        size = max(1, len(pages) // (self.jobs * 4))
+        return itertools.chain.from_iterable(self._pool.map(
+            render_batch,
+            [pages[index:index + size] for index in range(0, len(pages), size)],
+            itertools.repeat(include_hot_reload)
+        ))
+
+    def register_stage(
+        self,
+        name: str,
+        callback: typing.Callable[[Path, typing.Any, bool], typing.Any],
+        suffixes: typing.Iterable[str] = (".html",),
+        dom: bool = False,
+        dev: bool = True
+    ) -> None:
+        self.stages.append((plugin_load_order.index(name), tuple(suffixes), dom, dev, callback))
+        self.stages.sort(key = lambda stage: stage[0])
+
+    def has_stages(self, path: Path, dev: bool = False) -> bool:
+        return any(path.suffix in suffixes and (run_in_dev or not dev) for _, suffixes, _, run_in_dev, _ in self.stages)
+
+    def process(self, path: Path, content: typing.Any, dev: bool, after: typing.Optional[typing.Callable] = None) -> None:
+        self.processed.add(path)
+
+        stages = self.stages
+        if after is not None:
+            stages = stages[[stage[-1] for stage in stages].index(after) + 1:]
+
+        # DOM stages share a single selectolax tree, which only gets serialized when a text stage needs it
+        for _, suffixes, dom, run_in_dev, callback in stages:
+            if path.suffix not in suffixes or (dev and not run_in_dev):
+                continue
+
+            if dom and isinstance(content, (str, bytes)):
+                from selectolax.lexbor import LexborHTMLParser
+                content = LexborHTMLParser(content)
+
+            elif not dom and not isinstance(content, (str, bytes)):
+                content = content.html
+
+            content = callback(path, content, dev)
+
+            # Stages can hand back a future, the rest of the pipeline picks up once it resolves
+            if isinstance(content, Future):
+                return self.defer(path, content, dev, callback)
+
+        self.write(path, content if isinstance(content, (str, bytes)) else content.html)
+
+    def defer(self, path: Path, future: Future, dev: bool, after: typing.Callable) -> None:
+        self.processed.add(path)
+        self.deferred.append((path, future, dev, after))
+
+    def flush(self) -> None:
+        while self.deferred:
+            path, future, dev, callback = self.deferred.popleft()
+            self.process(path, future.result(), dev, callback)
+
+    def write(self, path: Path, content: str | bytes) -> None:
+        (self.written if self.state.write(path, content) else self.skipped).add(path)
+
+    def remove(self, path: Path) -> None:
+        for file in [path] + [path.with_name(path.name + extension) for _, extension in content_encodings]:
+            file.unlink(missing_ok = True)
+            self.state.outputs.pop(str(file.relative_to(self.destination)), None)
+            self.removed.add(file)
+
+    def is_dirty(self, path: Path) -> bool:
+        return path in self.written or self.state.is_dirty(path)
+
+    def is_unchanged(self, path: Path, content: str | bytes) -> bool:
+        return path not in self.written and self.state.is_unchanged(path, content)
+
+    def track_dependencies(self, page: Path, dependencies: typing.Optional[typing.Iterable[str]]) -> None:
+        for dependency in self.build_dependencies.pop(page, set()):
+            dependents = self.dependents.get(dependency)
+            if dependents is not None:
+                dependents.discard(page)
+                if not dependents:
+                    del self.dependents[dependency]
+
+        # Pages can reference the same thing more than once (ie. a logo in both the header and footer)
+        if dependencies is not None:
+            dependencies = self.build_dependencies[page] = set(dependencies)
+            for dependency in dependencies:
+                self.dependents.setdefault(dependency, set()).add(page)
+
     def register_file_associations(self, extension: str, callback: typing.Callable) -> None:
         self.file_assocs[extension] = callback
 
@@ -103,3 +536,20 @@ class NovaBuilder:
             return self.file_assocs[path.suffix](path)
         
         return str(path)
+
+# Parallel rendering
+worker_builder: typing.Optional[NovaBuilder] = None
+
+def initialize_worker(
+    source: Path,
+    destination: Path,
+    build_exclude: list[str],
+    cache: typing.Optional[Path],
+    file_assocs: dict[str, typing.Callable]
+) -> None:
+    global worker_builder
+    worker_builder = NovaBuilder(source, destination, build_exclude, None, cache = cache)
+    worker_builder.file_assocs = file_assocs
+
+def render_batch(pages: list[str], include_hot_reload: bool) -> list[tuple[str, set[str], list[str]]]:
+    return [worker_builder.render_page(page, include_hot_reload) for page in pages]  # type: ignore
@@ -1,26 +1,35 @@
 # Copyright (c) 2024-2025 iiPython
 
 # Modules
+import os
 import json
 import typing
 import signal
 import asyncio
+import hashlib
 import mimetypes
 import traceback
 import webbrowser
+from stat import S_ISREG
 from pathlib import Path
+from urllib.parse import unquote
 from threading import Event
+from concurrent.futures import ThreadPoolExecutor
 from http import HTTPStatus
+from collections import OrderedDict, deque
+from email.utils import formatdate, parsedate_to_datetime
 
 from watchfiles import awatch
 from websockets.http11 import Response
-from websockets.asyncio.server import serve
+from websockets.asyncio.server import serve, broadcast
 from websockets.datastructures import Headers
 
-from .building import NovaBuilder
+from .building import NovaBuilder, BuildInterrupted, content_encodings
 from .interface import Interface
 
 # Auto-reload
+hot_swappable = [".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".svg", ".ico", ".mp4", ".webm", ".mp3", ".ogg"]
+
 class FileAssociator:
     def __init__(self, builder: NovaBuilder) -> None:
         self.spa = builder.plugins.get("SPAPlugin")
@@ -36,78 +45,359 @@ class FileAssociator:
         return path.relative_to(self.spa_relative) \
             if path.is_relative_to(self.spa_relative) else path
 
+    def calculate_update(self, relative_path: Path) -> typing.Optional[tuple[str, str]]:
+        if relative_path.suffix in self.builder.file_assocs:
+            output = self.builder.file_assocs[relative_path.suffix](relative_path)
+
+        elif relative_path.parts[0] == "static":
+            output = relative_path.relative_to("static").as_posix()
+
+        else:
+            return None
+
+        # Stylesheets and images can be swapped out in place, anything else needs a reload
+        suffix = Path(output).suffix
+        if suffix == ".css":
+            return "css-update", f"/{output}"
+
+        elif suffix in hot_swappable:
+            return "asset-update", f"/{output}"
+
+        return None
+
     def calculate_reloads(self, relative_path: Path) -> list[Path]:
-        reloads = []
+        dependents = self.builder.dependents
 
         # Check if this change is part of a file dependency (ie. css or js)
         if relative_path.suffix in self.builder.file_assocs:
             check_path = self.builder.file_assocs[relative_path.suffix](relative_path)
-            for path, dependencies in self.builder.build_dependencies.items():
-                if check_path in dependencies:
-                    reloads.append(path)
+            reloads = [self.convert_path(path) for path in sorted(dependents.get(check_path, ()))]
 
         else:
-            def recurse(search_path: str, reloads: list = []) -> list:
-                for path, dependencies in self.builder.build_dependencies.items():
-                    if search_path.removeprefix("static/") in dependencies:
-                        reloads.append(self.convert_path(path))
-                        recurse(str(path), reloads)
-
-                return reloads
 
-            reloads = recurse(str(relative_path))
+            # Walk everything that depends on this file, pages can depend on each other too
+            reloads, visited = [], set()
+            queue = deque([relative_path.as_posix().removeprefix("static/")])
+            while queue:
+                for path in sorted(dependents.get(queue.popleft(), ())):
+                    if path not in visited:
+                        visited.add(path)
+                        reloads.append(self.convert_path(path))
+                        queue.append(path.as_posix())
 
-        if relative_path.suffix in [".jinja2", ".jinja", ".j2"] and relative_path not in reloads:
+        if relative_path.suffix in [".jinja2", ".jinja", ".j2"] and self.convert_path(relative_path) not in reloads:
             reloads.append(self.convert_path(relative_path))
 
         return reloads
 
+# Response caching
+class Route(typing.NamedTuple):
+    path: Path
+    mtime: int
+    size: int
+    content_type: typing.Optional[str]
+    variants: dict[str, "Route"]
+
+class RouteTable:
+    def __init__(self, destination: Path) -> None:
+        self.destination = destination
+        self.files: dict[str, Route] = {}
+        self.routes: dict[str, Route] = {}
+        self.paths: set[Path] = set()
+
+    def load(self, relative: str) -> typing.Optional[Route]:
+        path = self.destination / relative
+        try:
+            stat = path.stat()
+            return Route(path, stat.st_mtime_ns, stat.st_size, mimetypes.guess_file_type(path)[0], {}) \
+                if S_ISREG(stat.st_mode) else None
+
+        except OSError:
+            return None  # Gone, or a dangling symlink
+
+    def rebuild(self) -> None:
+        relatives = [
+            (Path(root) / filename).relative_to(self.destination).as_posix()
+            for root, _, filenames in os.walk(self.destination, followlinks = True) for filename in filenames
+        ]
+        self.files, self.routes = {}, {}
+        self.apply(relatives)
+
+    def update(self, paths: typing.Iterable[Path]) -> None:
+        relatives = set()
+        for path in paths:
+            if path.is_relative_to(self.destination):
+                relatives.add(path.relative_to(self.destination).as_posix())
+
+        self.apply(relatives)
+
+    def apply(self, relatives: typing.Iterable[str]) -> None:
+        files, routes = dict(self.files), dict(self.routes)
+
+        # Precompressed variants and the file they belong to always get looked at together
+        touched = set()
+        for relative in relatives:
+            for _, extension in content_encodings:
+                relative = relative.removesuffix(extension)
+
+            touched |= {relative} | {relative + extension for _, extension in content_encodings}
+
+        for relative in touched:
+            route = self.load(relative)
+            if route is None:
+                files.pop(relative, None)
+
+            else:
+                files[relative] = route
+
+        for relative in touched & set(files):
+            route, variants = files[relative], {}
+            for coding, extension in content_encodings:
+                variant = files.get(relative + extension)
+                if variant is not None and variant.mtime >= route.mtime:
+                    variants[coding] = variant._replace(content_type = route.content_type)
+
+            files[relative] = route._replace(variants = variants)
+
+        # Handle clean URLs, directory indexes take priority over pages of the same name
+        for key in {key for relative in touched for key in self.calculate_keys(relative)}:
+            for candidate in (f"{key}/index.html" if key else "index.html", f"{key}.html", key):
+                if candidate in files:
+                    routes[key] = files[candidate]
+                    break
+
+            else:
+                routes.pop(key, None)
+
+        # Swap everything in at once, requests are answered while this runs
+        self.files, self.routes, self.paths = files, routes, {route.path for route in files.values()}
+
+    @staticmethod
+    def calculate_keys(relative: str) -> set[str]:
+        keys = {relative, relative.removesuffix(".html")}
+        if relative == "index.html" or relative.endswith("/index.html"):
+            keys.add(relative.removesuffix("index.html").rstrip("/"))
+
+        return keys
+
+    def get(self, url: str) -> typing.Optional[Route]:
+        return self.routes.get(unquote(url.partition("?")[0]).strip("/"))
+
+class CachedResponse(typing.NamedTuple):
+    path: Path
+    mtime: int
+    size: int
+    headers: dict[str, str]
+    body: typing.Optional[bytes]
+
+class ResponseCache:
+    def __init__(self, max_size: int = 64 * 1024 ** 2, chunk_size: int = 4 * 1024 ** 2) -> None:
+        self.max_size, self.size, self.chunk_size = max_size, 0, chunk_size
+        self.entries: OrderedDict[Path, CachedResponse] = OrderedDict()
+
+    def get(self, route: Route, accept_encoding: str = "") -> CachedResponse:
+        accepted = {
+            coding for coding, *parameters in (
+                [item.strip() for item in value.split(";")] for value in accept_encoding.split(",")
+            )
+            if not any(parameter.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000") for parameter in parameters)
+        }
+
+        # Prefer the precompressed variants from the compress plugin, the route table only keeps up to date ones
+        for coding, _ in content_encodings:
+            if coding in accepted and coding in route.variants:
+                return self.load(route.variants[coding], coding)
+
+        return self.load(route)
+
+    def load(self, route: Route, coding: typing.Optional[str] = None) -> CachedResponse:
+        entry = self.entries.get(route.path)
+        if entry is not None:
+            if (entry.mtime, entry.size) == (route.mtime, route.size):
+                self.entries.move_to_end(route.path)
+                return entry
+
+            self.invalidate([route.path])
+
+        # Anything bigger than a quarter of the cache isn't worth keeping around, and gets read from disk on demand
+        body = route.path.read_bytes() if route.size <= self.max_size // 4 else None
+        etag = hashlib.sha1(body).hexdigest() if body is not None else f"{route.mtime:x}-{route.size:x}"
+
+        entry = CachedResponse(route.path, route.mtime, route.size, {
+            "ETag": f"\"{etag}\"",
+            "Last-Modified": formatdate(route.mtime / 10 ** 9, usegmt = True),
+            "Cache-Control": "no-cache",
+            "Accept-Ranges": "bytes",
+            "Vary": "Accept-Encoding"
+        } | ({"Content-Type": route.content_type} if route.content_type is not None else {}) \
+          | ({"Content-Encoding": coding} if coding is not None else {}), body)
+
+        if body is not None:
+            self.entries[route.path] = entry
+            self.size += len(body)
+            while self.size > self.max_size:
+                self.size -= len(self.entries.popitem(last = False)[1].body)
+
+        return entry
+
+    def invalidate(self, paths: typing.Iterable[Path]) -> None:
+        for path in paths:
+            if path in self.entries:
+                self.size -= len(self.entries.pop(path).body)
+
+    def read(self, entry: CachedResponse, start: int = 0, length: int = -1) -> bytes:
+        if entry.body is not None:
+            return entry.body[start:] if length < 0 else entry.body[start:start + length]
+
+        with entry.path.open("rb") as handle:
+            handle.seek(start)
+            return handle.read(length)
+
+    def get_range(self, entry: CachedResponse, headers: Headers) -> typing.Optional[tuple[int, int]]:
+        if "Range" not in headers:
+            return None
+
+        # A validator that doesn't match means the client's partial copy is outdated, so send everything
+        if "If-Range" in headers and headers["If-Range"].strip() not in (entry.headers["ETag"], entry.headers["Last-Modified"]):
+            return None
+
+        unit, _, ranges = headers["Range"].partition("=")
+        if unit.strip().lower() != "bytes" or "," in ranges:
+            return None
+
+        start, _, end = ranges.strip().partition("-")
+        try:
+            if not start:
+                start, end = max(entry.size - int(end), 0), entry.size - 1
+                if start > end:
+                    return (entry.size, entry.size)
+
+            else:
+                start, end = int(start), min(int(end), entry.size - 1) if end else entry.size - 1
+
+        except ValueError:
+            return None
+
+        if start > end and start < entry.size:
+            return None
+
+        # Keep each response bounded, clients simply ask for the rest afterwards
+        return (start, min(end, start + self.chunk_size - 1))
+
+    @staticmethod
+    def is_fresh(entry: CachedResponse, headers: Headers) -> bool:
+        if "If-None-Match" in headers:
+            return any(tag.strip() in (entry.headers["ETag"], "*") for tag in headers["If-None-Match"].split(","))
+
+        if "If-Modified-Since" in headers:
+            try:
+                return entry.mtime // 10 ** 9 <= parsedate_to_datetime(headers["If-Modified-Since"]).timestamp()
+
+            except (TypeError, ValueError):
+                return False
+
+        return False
+
 # Methods
 class Stack:
-    def __init__(self, host: str, port: int, auto_reload: bool, auto_open: bool, build_instance: NovaBuilder) -> None:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        auto_reload: bool,
+        auto_open: bool,
+        build_instance: NovaBuilder,
+        debounce: int = 100
+    ) -> None:
         self.host, self.port = host, port
         self.auto_reload, self.auto_open = auto_reload, auto_open
-        self.build_instance = build_instance
+        self.build_instance, self.debounce = build_instance, debounce
+
+        # Builds run one at a time, off of the event loop
+        self.executor = ThreadPoolExecutor(1)
 
         # Create a shared instance of the interface
         self.interface = Interface()
 
         # Handle connections
-        self.clients = set()
+        self.clients, self.responses = set(), ResponseCache()
+        self.write_limit = 256 * 1024
+        self.routes = RouteTable(build_instance.destination)
 
-    def build(self) -> None | float:
+    def build(self, changes: typing.Optional[set[Path]] = None) -> None | float:
         try:
-            return self.build_instance.wrapped_build(include_hot_reload = self.auto_reload)
+            return self.build_instance.wrapped_build(include_hot_reload = self.auto_reload, changes = changes)
+
+        except BuildInterrupted:
+            return None
 
         except Exception as e:
             frames = traceback.extract_tb(e.__traceback__)
             self.interface.update_last_change(error = f"\nFollowing code:\n    > [b]{frames[-2][3]}[/]\n\n[red]{e}[/]")
             return None
 
+        finally:
+            if changes is None:
+                self.routes.rebuild()
+
+            else:
+                self.routes.update(self.calculate_outputs(self.build_instance.changes or changes))
+
+    def calculate_outputs(self, changes: set[Path]) -> set[Path]:
+        builder = self.build_instance
+        outputs = builder.written | builder.removed | {builder.state.location}
+        for change in changes:
+            if not change.is_relative_to(builder.source):
+                continue
+
+            relative = change.relative_to(builder.source)
+            if relative.parts[0] == "static":
+                outputs.add(builder.destination / relative.relative_to("static"))
+
+            elif relative.suffix in builder.file_assocs:
+
+                # Compilers can write more than the file that changed (ie. for a sass partial), so recheck all of their output
+                output = Path(builder.file_assocs[relative.suffix](relative))
+                directory = builder.destination / output.parts[0]
+                outputs |= set(directory.rglob(f"*{output.suffix}")) | \
+                    {path for path in self.routes.paths if path.is_relative_to(directory) and path.suffix == output.suffix}
+
+            elif builder.is_page(change):
+                outputs.add(builder.destination / relative.with_suffix(".html"))
+
+        return outputs
+
     async def create_app(self, handler: typing.Callable) -> None:
         def process_request(connection, request):
             if request.path != "/_nova":
                 self.interface.update_log("Request", request.path)
-                destination_file = self.build_instance.destination / Path(request.path[1:])
-                if not destination_file.is_relative_to(self.build_instance.destination):
-                    return connection.respond(HTTPStatus.UNAUTHORIZED, "Nuh uh.\n")
-
-                elif destination_file.is_dir():
-                    destination_file = destination_file / "index.html"
+                route = self.routes.get(request.path)
+                if route is None:
+                    return connection.respond(HTTPStatus.NOT_FOUND, "File not found.\n")
 
-                final_path = destination_file.with_suffix(".html")
-                if not final_path.is_file():
-                    final_path = destination_file
+                # Outputs removed outside of the pipeline only leave the table once something touches them again
+                try:
+                    entry = self.responses.get(route, request.headers.get("Accept-Encoding", ""))
 
-                if not final_path.is_file():
+                except OSError:
                     return connection.respond(HTTPStatus.NOT_FOUND, "File not found.\n")
+                if self.responses.is_fresh(entry, request.headers):
+                    headers = {key: value for key, value in entry.headers.items() if key not in ("Content-Type", "Content-Encoding")}
+                    return Response(HTTPStatus.NOT_MODIFIED, "Not Modified", Headers(headers), b"")
+
+                byte_range = self.responses.get_range(entry, request.headers)
+                if byte_range is not None:
+                    start, end = byte_range
+                    if start >= entry.size:
+                        headers = {"Content-Range": f"bytes */{entry.size}", "Content-Length": "0"}
+                        return Response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, "Range Not Satisfiable", Headers(headers), b"")
+
+                    body = self.responses.read(entry, start, end - start + 1)
+                    headers = entry.headers | {"Content-Range": f"bytes {start}-{end}/{entry.size}", "Content-Length": str(len(body))}
+                    return Response(HTTPStatus.PARTIAL_CONTENT, "Partial Content", Headers(headers), body)
 
-                content_type = mimetypes.guess_file_type(final_path)[0]
-                return Response(
-                    HTTPStatus.OK, "OK",
-                    Headers({"Content-Type": content_type} if content_type is not None else {}),
-                    final_path.read_bytes()
-                )
+                body = self.responses.read(entry)
+                return Response(HTTPStatus.OK, "OK", Headers(entry.headers | {"Content-Length": str(len(body))}), body)
 
         try:
             async with serve(handler, self.host, self.port, process_request = process_request) as ws:
@@ -117,14 +407,23 @@ class Stack:
             return
 
     async def broadcast(self, data: typing.Any) -> None:
-        self.interface.update_log("Broadcast", json.dumps(data))
+        message = json.dumps(data)
+        self.interface.update_log("Broadcast", message)
+
+        # Clients that stopped reading get dropped instead of piling up messages
+        clients = set()
         for client in self.clients:
-            await client.send(json.dumps(data))
+            if client.transport.get_write_buffer_size() > self.write_limit:
+                client.transport.abort()
+                continue
+
+            clients.add(client)
+
+        broadcast(clients, message)
 
     async def kill(self) -> None:
         self.task.cancel()
-        for client in self.clients.copy():
-            await client.close()
+        await asyncio.gather(*(client.close() for client in self.clients.copy()))
 
     async def start(self) -> None:
         async def handler(websocket) -> None:
@@ -159,27 +458,74 @@ class Stack:
         stop_event = Event()
         def handle_sigint(sig, frame):
             stop_event.set()
+            self.build_instance.interrupt.set()
             asyncio.create_task(self.kill())
 
         signal.signal(signal.SIGINT, handle_sigint)
 
+        # Collect changes as they come in, they also supersede whatever build is running
+        pending, arrived = set(), asyncio.Event()
+        async def watch() -> None:
+            async for changes in awatch(self.build_instance.source, stop_event = stop_event):
+                pending.update(changes)
+                self.build_instance.interrupt.set()
+                arrived.set()
+
+        asyncio.create_task(watch())
+
         associator = FileAssociator(self.build_instance)
-        async for changes in awatch(self.build_instance.source, stop_event = stop_event):
-            time = self.build()
+        while not stop_event.is_set():
+            await arrived.wait()
+
+            # Wait for things to settle down (ie. a branch switch or a formatter run)
+            while True:
+                arrived.clear()
+                try:
+                    await asyncio.wait_for(arrived.wait(), self.debounce / 1000)
+
+                except TimeoutError:
+                    break
+
+            changes = set(pending)
+            pending.clear()
+
+            self.build_instance.interrupt.clear()
+            time = await asyncio.get_running_loop().run_in_executor(
+                self.executor,
+                self.build,
+                {Path(change[1]) for change in changes}
+            )
+            self.responses.invalidate(set(self.responses.entries) - self.routes.paths)
             if time is None:
+
+                # Failed and superseded builds get redone alongside the next changes, targeted builds trust
+                # everything outside of their change set, so it can't be dropped until a build goes through
+                pending.update(changes)
                 continue
 
-            # Convert paths to relative
-            paths = []
-            for change in changes:
-                path = Path(change[1]).relative_to(self.build_instance.source)
+            # Convert paths to relative, swapping assets in place where the browser can
+            paths, updates = [], []
+            for change in self.build_instance.changes or []:  # With moved directories expanded into their files
+                path = change.relative_to(self.build_instance.source)
+                update = associator.calculate_update(path)
+                if update is not None:
+                    route = self.routes.get(update[1])
+                    if route is not None:
+                        updates.append({"type": update[0], "path": update[1], "version": f"{route.mtime:x}"})
+                        continue
+
                 for page in associator.calculate_reloads(path):
                     clean = page.with_suffix("")
                     paths.append(f"/{str(clean.parent) + '/' if str(clean.parent) != '.' else ''}{clean.name if clean.name != 'index' else ''}")
 
-            await self.broadcast(paths)
+            for update in updates:
+                await self.broadcast(update)
+
+            if paths:
+                await self.broadcast({"type": "page-reload", "paths": paths})
+
             self.interface.update_last_change(
-                str(path), time, paths,  # type: ignore
+                str(path), time, paths + [update["path"] for update in updates],  # type: ignore
                 str(self.build_instance.source.relative_to(Path.cwd())),
                 str(self.build_instance.destination.relative_to(Path.cwd()))
             )
@@ -44,6 +44,9 @@ available_plugins = {
     "minify": {
         "module": plugin_load_callback(".plugin_minify", "MinifyPlugin"),
         "requirements": ["minify-html"]
+    },
+    "compress": {
+        "module": plugin_load_callback(".plugin_compress", "CompressPlugin")
     }
 }
 
@@ -100,7 +103,7 @@ class StaticFileBasedBuilder():
         config: dict
     ) -> None:
         self.destination_extension = destination_extension
-        self.source, self.destination = builder.source, builder.destination
+        self.builder, self.source, self.destination = builder, builder.source, builder.destination
 
         for association in file_associations:
             builder.register_file_associations(association, self.patch_filename)
@@ -117,6 +120,9 @@ class StaticFileBasedBuilder():
         system = platform.system().lower()
         self.build_binary = Path(__file__).parent / "binaries" / system / build_binaries[system]
 
+    def __getstate__(self) -> dict:
+        return self.__dict__ | {"builder": None}  # Render workers only need the file associations
+
     def patch_filename(self, filename: Path) -> str:
         if filename.parents[-2].name != self.mapping[0]:  # Not our problem
             return str(filename)
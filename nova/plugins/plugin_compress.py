@@ -0,0 +1,69 @@
+# Copyright (c) 2025 iiPython
+
+# Modules
+import os
+import gzip
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import brotli
+
+except ImportError:
+    brotli = None
+
+from . import rcon, encoding
+from nova.internal.building import NovaBuilder
+
+# Compression methods
+def compress_gzip(data: bytes) -> bytes:
+    return gzip.compress(data, 9, mtime = 0)  # Fixed mtime keeps the output stable between builds
+
+def compress_brotli(data: bytes) -> bytes:
+    return brotli.compress(data)  # type: ignore
+
+methods = {
+    "gzip": (".gz", compress_gzip),
+    "br": (".br", compress_brotli)
+}
+
+# Handle plugin
+class CompressPlugin:
+    def __init__(self, builder: NovaBuilder, config: dict) -> None:
+        self.builder, self.config = builder, config
+
+        self.methods = {}
+        for method in config.get("formats", ["gzip", "br"]):
+            if method not in methods:
+                rcon.print(f"[yellow]\u26a0  Compression format unknown: '{method}'.[/]")
+
+            elif method == "br" and brotli is None:
+                rcon.print("[yellow]\u26a0  The compress plugin requires the brotli package in order to perform Brotli compression.[/]")
+
+            else:
+                self.methods[method] = methods[method]
+
+        self.pool = ThreadPoolExecutor(config.get("jobs") or os.cpu_count())
+        builder.register_stage(
+            "compress",
+            self.process,
+            config.get("suffixes", [".html", ".css", ".js", ".svg", ".json"]),
+            dev = bool(config.get("compress_dev"))
+        )
+
+    def process(self, path: Path, content: str | bytes, dev: bool) -> str | bytes:
+        data = content.encode(encoding) if isinstance(content, str) else content
+        variants = [(path.with_name(path.name + extension), method) for extension, method in self.methods.values()]
+
+        # Nothing to do if neither the file nor its variants changed since the last build
+        if self.builder.is_unchanged(path, data) and all(self.is_fresh(path, variant) for variant, _ in variants):
+            return content
+
+        for variant, method in variants:
+            variant.unlink(missing_ok = True)  # Otherwise an identical variant would be skipped and stay older than the file
+            self.builder.defer(variant, self.pool.submit(method, data), dev, self.process)
+
+        return content
+
+    def is_fresh(self, path: Path, variant: Path) -> bool:
+        return not self.builder.is_dirty(variant) and variant.stat().st_mtime_ns >= path.stat().st_mtime_ns
@@ -1,15 +1,24 @@
 # Copyright (c) 2024 iiPython
 
 # Modules
+import os
+import json
+import typing
+import atexit
 import shutil
+import hashlib
+import threading
 import subprocess
 from pathlib import Path
+from importlib.metadata import version
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
 
 import minify_html
 
 from . import rcon, encoding
 from .modules import rjsmin, rcssmin
-from nova.internal.building import NovaBuilder
+from nova import __version__
+from nova.internal.building import NovaBuilder, prune_cache
 
 # Plugin defaults
 # If you need to adjust these, you should do so in nova.json, not here.
@@ -34,6 +43,70 @@ config_defaults = {
     "keep_comments": False
 }
 
+# Worker functions (the regex minifiers are built inside closures, which can't be pickled)
+def minify_js_native(content: str) -> str:
+    return rjsmin.jsmin(content)
+
+def minify_css_native(content: str) -> str:
+    return rcssmin.cssmin(content)
+
+def minify_external(content: str, command: list[str]) -> str:
+    result = subprocess.run(command, input = content, capture_output = True, text = True, encoding = encoding)
+    return result.stdout if result.returncode == 0 else content
+
+# Batched external minification
+driver_js = Path(__file__).parents[1] / "assets/minify.js"
+
+class ExternalMinifier:
+    def __init__(self) -> None:
+        self.modules = {}
+        for tool in ["uglifyjs", "csso"]:
+            binary = shutil.which(tool)
+            if binary is not None:
+                self.modules[tool] = str(Path(binary).resolve().parents[1])
+
+        # Each worker thread streams its files through its own node process
+        self.local, self.processes = threading.local(), []
+        self.available = shutil.which("node") is not None and bool(self.modules)
+        atexit.register(self.close)
+
+    def driver(self) -> subprocess.Popen:
+        if getattr(self.local, "process", None) is None:
+            self.local.process = subprocess.Popen(
+                ["node", driver_js, json.dumps(self.modules)],
+                stdin = subprocess.PIPE,
+                stdout = subprocess.PIPE,
+                stderr = subprocess.DEVNULL,
+                text = True,
+                encoding = encoding
+            )
+            self.processes.append(self.local.process)
+
+        return self.local.process
+
+    def minify(self, content: str, tool: str, command: list[str]) -> str:
+        if self.available and tool in self.modules:
+            try:
+                process = self.driver()
+                process.stdin.write(json.dumps({"tool": tool, "code": content}) + "\n")  # type: ignore
+                process.stdin.flush()  # type: ignore
+
+                response = json.loads(process.stdout.readline())  # type: ignore
+                if "code" in response:
+                    return response["code"]
+
+            except (OSError, ValueError):
+                self.available = False  # The driver died, don't bother restarting it
+
+        # Fall back to spawning the tool for this file
+        return minify_external(content, command)
+
+    def close(self) -> None:
+        for process in self.processes:
+            if process.poll() is None:
+                process.stdin.close()  # type: ignore
+                process.wait()
+
 # Handle plugin
 class MinifyPlugin:
     def __init__(self, builder: NovaBuilder, config: dict) -> None:
@@ -61,28 +134,106 @@ class MinifyPlugin:
             else:
                 self.mapping[f".{method}"] = getattr(self, f"_minify_{method}_{option}")
 
-    def on_build(self, dev: bool) -> None:
-        if dev and not self.config.get("minify_dev"):
-            return  # Minification is disabled in development
+        # Handle parallel minification and caching
+        self.jobs = config.get("jobs") or os.cpu_count() or 1
+        self.cache = builder.cache / "minify" if builder.cache is not None else None
+        if self.cache is not None:
+            self.cache.mkdir(parents = True, exist_ok = True)
+
+        self._pools, self.external, self.versions = {}, ExternalMinifier(), {}
+
+        # Minification is disabled in development unless asked for
+        builder.register_stage("minify", self.process, config["suffixes"], dev = bool(config.get("minify_dev")))
+
+    def pool(self, kind: str) -> Executor:
+        if kind not in self._pools:
+            self._pools[kind] = {
+                "native": lambda: ProcessPoolExecutor(self.jobs),
+                "external": lambda: ThreadPoolExecutor(self.config.get("external_jobs", 4)),
+                "html": lambda: ThreadPoolExecutor(self.jobs)
+            }[kind]()
+
+        return self._pools[kind]
+
+    def process(self, path: Path, content: str, dev: bool) -> Future:
+        method = self.mapping[path.suffix]
+        key = hashlib.sha1("\0".join([
+            method.__name__,
+            self.calculate_version(method),
+            json.dumps(self.options, sort_keys = True) if method == self._minify_html else "",
+            content
+        ]).encode(encoding)).hexdigest()
+
+        # Check if we've minified this exact content before
+        if self.cache is not None:
+            cached = self.cache / f"{__version__}-{key}"
+            if cached.is_file():
+                os.utime(cached)
+
+                future = Future()
+                future.set_result(cached.read_text(encoding))
+                return future
+
+        future = method(content)
+        if self.cache is not None:
+            def store(result: Future) -> None:
+                if result.exception() is not None:
+                    return
+
+                # Identical content can be minifying on another thread, and a half written entry would be trusted forever
+                temporary = cached.with_name(f"{cached.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+                try:
+                    temporary.write_text(result.result(), encoding)
+                    os.replace(temporary, cached)
+
+                except OSError:
+                    temporary.unlink(missing_ok = True)
+
+            future.add_done_callback(store)
+
+        return future
+
+    def calculate_version(self, method: typing.Callable) -> str:
+        if method.__name__ not in self.versions:
+
+            # Upgrading a minifier has to invalidate whatever it produced before
+            tool = {"_minify_js_external": "uglifyjs", "_minify_css_external": "csso"}.get(method.__name__)
+            if method == self._minify_html:
+                self.versions[method.__name__] = version("minify_html")
+
+            elif tool is not None:
+                try:
+                    self.versions[method.__name__] = subprocess.run(
+                        [tool, "--version"],
+                        capture_output = True,
+                        text = True,
+                        encoding = encoding
+                    ).stdout.strip()
+
+                except OSError:
+                    self.versions[method.__name__] = ""
 
-        for file in self.builder.destination.rglob("*"):
-            if file.suffix not in self.config["suffixes"]:
-                continue
+            else:
+                self.versions[method.__name__] = ""  # Bundled with Nova, covered by the version prefix
 
-            self.mapping[file.suffix](file)
+        return self.versions[method.__name__]
+
+    def on_build(self, dev: bool) -> None:
+        if self.cache is not None:
+            prune_cache(self.cache, self.config.get("cache_size", 64 * 1024 ** 2), f"{__version__}-")
 
     # Minification steps
-    def _minify_js_native(self, path: Path) -> None:
-        path.write_text(rjsmin.jsmin(path.read_text(encoding)))
+    def _minify_js_native(self, content: str) -> Future:
+        return self.pool("native").submit(minify_js_native, content)
 
-    def _minify_js_external(self, path: Path) -> None:
-        subprocess.run(["uglifyjs", path, "--rename", "--toplevel", "-c", "-m", "-o", path])
+    def _minify_js_external(self, content: str) -> Future:
+        return self.pool("external").submit(self.external.minify, content, "uglifyjs", ["uglifyjs", "--rename", "--toplevel", "-c", "-m"])
 
-    def _minify_css_native(self, path: Path) -> None:
-        path.write_text(rcssmin.cssmin(path.read_text(encoding)))
+    def _minify_css_native(self, content: str) -> Future:
+        return self.pool("native").submit(minify_css_native, content)
 
-    def _minify_css_external(self, path: Path) -> None:
-        subprocess.run(["csso", "-i", path, "-o", path])
+    def _minify_css_external(self, content: str) -> Future:
+        return self.pool("external").submit(self.external.minify, content, "csso", ["csso"])
 
-    def _minify_html(self, path: Path) -> None:
-        path.write_text(minify_html.minify(path.read_text(encoding), **self.options))
+    def _minify_html(self, content: str) -> Future:
+        return self.pool("html").submit(minify_html.minify, content, **self.options)
@@ -1,30 +1,23 @@
 # Copyright (c) 2024 iiPython
 
 # Modules
+from pathlib import Path
+
 from selectolax.lexbor import LexborHTMLParser
 
-from . import encoding
 from nova.internal.building import NovaBuilder
 
 # Handle plugin
 class NoncePlugin:
     def __init__(self, builder: NovaBuilder, config: dict) -> None:
-        self.nonce = config["nonce"]
-        self.destination = builder.destination
-
-    def on_build(self, dev: bool) -> None:
-        if dev:
-            return
+        self.config, self.nonce = config, config["nonce"]
+        builder.register_stage("nonce", self.process, dom = True, dev = False)
 
-        for file in self.destination.rglob("*"):
-            if file.suffix != ".html":
+    def process(self, path: Path, root: LexborHTMLParser, dev: bool) -> LexborHTMLParser:
+        for element in root.css("script, link, style"):
+            if element.tag == "link" and element.attrs.get("rel") != "stylesheet":
                 continue
 
-            root = LexborHTMLParser(file.read_text(encoding))
-            for element in root.css("script, link, style"):
-                if element.tag == "link" and element.attrs.get("rel") != "stylesheet":
-                    continue
-
-                element.attrs["nonce"] = self.nonce
+            element.attrs["nonce"] = self.nonce
 
-            file.write_text(root.html)  # type: ignore
+        return root
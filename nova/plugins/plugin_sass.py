@@ -1,8 +1,18 @@
 # Copyright (c) 2024 iiPython
 
 # Modules
+import re
+import time
+import atexit
+import threading
 import subprocess
-from . import StaticFileBasedBuilder
+from pathlib import Path
+
+from . import StaticFileBasedBuilder, encoding
+
+# Raised when the watcher fails to compile a stylesheet, so the error ends up in the interface
+class SassError(Exception):
+    pass
 
 # Handle plugin
 class SassPlugin(StaticFileBasedBuilder):
@@ -15,11 +25,122 @@ class SassPlugin(StaticFileBasedBuilder):
             *args
         )
 
+        # Handle the persistent compiler used while developing
+        self.watcher, self.ready = None, False
+        self.compiled, self.last_change = threading.Condition(), 0.0
+        self.reports, self.errors = {}, {}  # When sass last reported on each stylesheet, and what went wrong with it
+        atexit.register(self.stop_watcher)
+
+    def __getstate__(self) -> dict:
+        return super().__getstate__() | {"watcher": None, "compiled": None}
+
     def on_build(self, dev: bool) -> None:
-        subprocess.run([
+        command = [
             self.build_binary,
             ":".join([str(self.source), str(self.destination)]),
             "-s",
             self.config.get("style", "expanded"),
             "--no-source-map"
-        ])
+        ]
+        if not dev:
+            subprocess.run(command)
+            return
+
+        if self.watcher is None or self.watcher.poll() is not None:
+            return self.start_watcher(command)
+
+        # Sass only recompiles what changed, we just have to wait for it to finish
+        if self.builder.changes is not None:
+            files = [file for file in self.builder.changes if file.is_relative_to(self.source) and file.is_file()]
+
+        else:
+            files = list(self.source.rglob("*"))
+
+        files = [file for file in files if file.suffix in (".scss", ".sass") and file.stat().st_mtime > self.last_change]
+        if not files:
+            return
+
+        # Sass recompiles every stylesheet that (indirectly) uses what changed, partials nothing imports never compile
+        self.last_change = max(file.stat().st_mtime for file in files)
+        stylesheets = {
+            stylesheet.resolve(): change for stylesheet, change in self.calculate_dependents(files).items()
+            if not stylesheet.name.startswith("_")
+        }
+        with self.compiled:
+            self.compiled.wait_for(
+                lambda: all(self.reports.get(stylesheet, 0.0) >= change for stylesheet, change in stylesheets.items()),
+                timeout = 10
+            )
+            errors = [self.errors[stylesheet] for stylesheet in sorted(stylesheets) if stylesheet in self.errors]
+
+        if errors:
+            raise SassError("\n\n".join(errors))
+
+    def calculate_dependents(self, files: list[Path]) -> dict[Path, float]:
+        contents = {
+            file: file.read_text(encoding)
+            for file in self.source.rglob("*") if file.suffix in (".scss", ".sass") and file.is_file()
+        }
+
+        # Map everything that has to recompile to the latest change it has to pick up
+        dependents = {}
+        for file in files:
+            change, seen, queue = file.stat().st_mtime, {file}, [file]
+            while queue:
+                name = re.escape(queue.pop().stem.removeprefix("_"))
+                expression = re.compile(rf"@(?:use|forward|import)\s+[\"'](?:[^\"']*/)?_?{name}(?:\.s[ac]ss)?[\"']")
+                for stylesheet, content in contents.items():
+                    if stylesheet not in seen and expression.search(content):
+                        seen.add(stylesheet)
+                        queue.append(stylesheet)
+
+            for stylesheet in seen:
+                dependents[stylesheet] = max(dependents.get(stylesheet, 0.0), change)
+
+        return dependents
+
+    def start_watcher(self, command: list) -> None:
+        self.ready, self.last_change = False, time.time()
+        self.watcher = subprocess.Popen(
+            command + ["--watch"],
+            stdout = subprocess.PIPE,
+            stderr = subprocess.STDOUT,
+            text = True,
+            encoding = encoding
+        )
+        threading.Thread(target = self.read_watcher, args = (self.watcher,), daemon = True).start()
+
+        # Wait for the initial compilation
+        with self.compiled:
+            self.compiled.wait_for(lambda: self.ready, timeout = 30)
+
+    def read_watcher(self, watcher: subprocess.Popen) -> None:
+        error = []
+        for line in watcher.stdout:  # type: ignore
+            with self.compiled:
+                compiled = re.match(r"Compiled (.+) to .+\.$", line.rstrip())
+                if line.startswith("Sass is watching"):
+                    self.ready = True
+
+                elif compiled is not None:
+                    source = Path(compiled.group(1)).resolve()
+                    self.reports[source] = time.time()
+                    self.errors.pop(source, None)
+
+                # Errors span several lines, the last one names the stylesheet that failed
+                elif line.startswith("Error") or error:
+                    error.append(line.rstrip())
+                    failed = re.match(r"\s*(.+\.s[ac]ss) \d+:\d+\s+root stylesheet", line)
+                    if failed is not None:
+                        source = Path(failed.group(1)).resolve()
+                        self.reports[source], self.errors[source], error = time.time(), "\n".join(error), []
+
+                self.compiled.notify_all()
+
+        with self.compiled:
+            self.ready = True
+            self.compiled.notify_all()
+
+    def stop_watcher(self) -> None:
+        if self.watcher is not None and self.watcher.poll() is None:
+            self.watcher.terminate()
@@ -1,12 +1,15 @@
 # Copyright (c) 2024 iiPython
 
 # Modules
-import shutil
+import json
+import hashlib
 from pathlib import Path
+from collections import Counter
+from urllib.parse import urlsplit
 
 from selectolax.lexbor import LexborHTMLParser
 
-from . import encoding
+from . import rcon, encoding
 from nova.internal.building import NovaBuilder
 
 # Initialization
@@ -16,52 +19,175 @@ template_js = (Path(__file__).parents[1] / "assets/spa.js").read_text(encoding)
 class SPAPlugin:
     def __init__(self, builder: NovaBuilder, config: dict) -> None:
         mapping = config["mapping"].split(":")
+        self.builder = builder
         self.config, self.target, self.external, (self.source, self.destination) = \
             config, config["target"], config["external"], mapping
 
         # Handle remapping
         self.source = builder.destination / self.source
         self.destination = builder.destination / self.destination
+        self.manifest = self.source / "manifest.json"
+
+        # Handle prefetching
+        self.prefetch = config.get("prefetch", "none")
+        if self.prefetch not in ("none", "hover", "viewport", "idle"):
+            rcon.print(f"[yellow]\u26a0  SPA prefetch strategy unknown: '{self.prefetch}', prefetching is disabled.[/]")
+            self.prefetch = "none"
 
         # Handle caching
-        self._cached_files = None
+        self._cached_key, self._cached_snippet, self._cached_digest = None, "", ""
 
-    def on_build(self, dev: bool) -> None:
-        files = [file for file in self.source.rglob("*") if file.is_file()]
-        if files == self._cached_files:
-            return
+        # Keep track of which snippet every page was last split with, what each page links to, and where its fragment went
+        self.state_location = builder.cache / "spa.json" if builder.cache is not None else None
+        self.snippets, self.links, self.fragments, self.superseded = {}, {}, {}, {}
+        if self.state_location is not None and self.state_location.is_file():
+            state = json.loads(self.state_location.read_text(encoding))
+            self.snippets, self.links, self.fragments, self.superseded = \
+                state.get("snippets", {}), state.get("links", {}), state.get("fragments", {}), state.get("superseded", {})
+
+        builder.register_stage("spa", self.process, dom = True)
+
+    def calculate_pages(self) -> dict[str, Path]:
+        return {
+            page: file for page, file in (
+                (page, self.builder.destination / Path(page).with_suffix(".html")) for page in self.builder.pages
+            )
+            if file.is_relative_to(self.source)
+        }
+
+    def calculate_route(self, file: Path) -> str:
+        return f"/{file.relative_to(self.source).with_suffix('') if file.name != 'index.html' else ''}"
+
+    def calculate_title(self, route: str) -> str:
+        slug = route[1:]
+        return self.config["title"] + (self.config["title_sep"] + slug[0].upper() + slug[1:] if slug else "")
 
-        self._cached_files = files
+    def calculate_popular(self, routes: list[str]) -> list[str]:
+        if self.prefetch != "idle":
+            return []
 
-        page_list = ", ".join([
-            f"\"/{file.relative_to(self.source).with_suffix('') if file.name != 'index.html' else ''}\""
-            for file in files
-        ])
-        snippet = template_js % (page_list, self.target, self.config["title"], self.config["title_sep"])
+        # The pages linked to the most are the ones most likely to be visited next
+        counts = Counter(link for route in routes for link in self.links.get(route, []) if link in routes)
+        return [route for route, _ in sorted(counts.items(), key = lambda item: (-item[1], item[0]))][:self.config.get("prefetch_limit", 5)]
+
+    def calculate_snippet(self, dev: bool) -> str:
+        files = list(self.calculate_pages().values())
+        if files == self._cached_key:
+            return self._cached_snippet
+
+        self._cached_key = files
+
+        page_list = ", ".join([f"\"{self.calculate_route(file)}\"" for file in files])
+        snippet = template_js % (
+            page_list,
+            json.dumps(self.prefetch),
+            json.dumps(self.config.get("cache_size", 50)),
+            f"/{self.manifest.relative_to(self.builder.destination).as_posix()}",
+            self.target
+        )
         if self.external:
             js_location = self.destination / "js/spa.js"
             js_location.parent.mkdir(parents = True, exist_ok = True)
-            js_location.write_text(snippet)
+            self.builder.process(js_location, snippet, dev)
             snippet = "<script src = \"/js/spa.js\" async defer>"
 
         else:
             snippet = f"<script>{snippet}</script>"
 
-        # Handle iteration
-        for file in self.source.rglob("*"):
-            if not file.is_file():
-                continue
+        self._cached_snippet, self._cached_digest = snippet, hashlib.sha1(snippet.encode()).hexdigest()
+        return snippet
+
+    def on_build(self, dev: bool) -> None:
+        self.calculate_snippet(dev)
+
+        # Only pages split with an outdated snippet (ie. the page list changed) need splitting again,
+        # shells of pages that just rendered can still be waiting on a deferred stage to be written
+        pages, stale = self.calculate_pages(), []
+        for page, file in pages.items():
+            shell = self.destination / file.relative_to(self.source)
+            if self.snippets.get(shell.relative_to(self.builder.destination).as_posix()) != self._cached_digest or \
+                (self.builder.changes is None and file not in self.builder.rendered and not shell.is_file()):
+                stale.append(page)
+
+        if stale:
+            self.builder.build_pages(stale, dev, force = True)
+
+        shells = {
+            (self.destination / file.relative_to(self.source)).relative_to(self.builder.destination).as_posix()
+            for file in pages.values()
+        }
+        routes = {self.calculate_route(file) for file in pages.values()}
+        for route in set(self.fragments) - routes:
+            self.builder.remove(self.builder.destination / self.fragments.pop(route).lstrip("/"))
+            if route in self.superseded:
+                self.builder.remove(self.builder.destination / self.superseded.pop(route).lstrip("/"))
+
+        # Pages that went away take their shell along with them
+        for shell in set(self.snippets) - shells:
+            self.builder.remove(self.builder.destination / shell)
+            del self.snippets[shell]
+
+        self.links = {route: links for route, links in self.links.items() if route in routes}
+
+        # Let the runtime know where every fragment currently lives, and what to fetch ahead of time
+        self.source.mkdir(parents = True, exist_ok = True)
+        self.builder.process(self.manifest, json.dumps({
+            "routes": {
+                route: {"fragment": self.fragments[route], "title": self.calculate_title(route)}
+                for route in sorted(routes) if route in self.fragments
+            },
+            "popular": self.calculate_popular(sorted(routes))
+        }), dev)
+
+        if self.state_location is not None:
+            self.state_location.parent.mkdir(parents = True, exist_ok = True)
+            self.state_location.write_text(json.dumps({
+                "snippets": self.snippets,
+                "links": self.links,
+                "fragments": self.fragments,
+                "superseded": self.superseded
+            }), encoding)
+
+    def process(self, path: Path, root: LexborHTMLParser, dev: bool) -> LexborHTMLParser | str:
+        if not path.is_relative_to(self.source) or path not in self.builder.rendered:
+            return root
+
+        new_location = self.destination / path.relative_to(self.source)
+        new_location.parent.mkdir(exist_ok = True, parents = True)
+
+        # Strip out everything except for the content, before the snippet lands in the tree
+        target = root.css_first(self.target)
+        fragment = target.html if target is not None else root.html
+
+        # Remember where this page links to, for picking what to prefetch
+        if self.prefetch == "idle":
+            self.links[self.calculate_route(path)] = sorted({
+                urlsplit(link.attributes["href"] or "").path
+                for link in (target or root).css("a[href]")
+                if (link.attributes["href"] or "").startswith("/")
+            } - {self.calculate_route(path)})
+
+        # Content hashed copies of the fragment never change, so they can be cached forever, the stages after us
+        # (nonce, minify, compress) still rewrite the bytes, so their configuration goes into the hash too
+        route = self.calculate_route(path)
+        digest = hashlib.sha1((self.builder.calculate_fingerprint(dev) + fragment).encode()).hexdigest()
+        fragment_location = path.with_name(f"{path.stem}.{digest[:12]}{path.suffix}")
+        fragment_url = f"/{fragment_location.relative_to(self.builder.destination).as_posix()}"
+
+        # Sessions that loaded the previous manifest still ask for the fragment before this one, so that one sticks around
+        # until the page changes again
+        previous = self.fragments.get(route, fragment_url)
+        if previous != fragment_url:
+            if self.superseded.get(route, fragment_url) != fragment_url:
+                self.builder.remove(self.builder.destination / self.superseded[route].lstrip("/"))
 
-            new_location = self.destination / (file.relative_to(self.source))
-            new_location.parent.mkdir(exist_ok = True, parents = True)
+            self.superseded[route] = previous
 
-            # Add JS snippet
-            shutil.copy(file, new_location)
-            root = LexborHTMLParser(new_location.read_text(encoding))
-            (root.css_first("body") or root).insert_child(snippet)
-            new_location.write_text(root.html)
+        self.fragments[route] = fragment_url
+        self.builder.process(fragment_location, fragment, dev, self.process)
 
-            # Strip out everything except for the content
-            target = LexborHTMLParser(file.read_text(encoding)).css_first(self.target)
-            if target is not None:
-                file.write_text(target.html)
+        # Add JS snippet, the copy still has to go through the stages after us
+        (root.css_first("body") or root).insert_child(self.calculate_snippet(dev))
+        self.snippets[new_location.relative_to(self.builder.destination).as_posix()] = self._cached_digest
+        self.builder.process(new_location, root, dev, self.process)
+        return fragment  # type: ignore
@@ -2,19 +2,63 @@
 
 # Modules
 import os
+import json
 import shutil
 import atexit
+import hashlib
 from pathlib import Path
 
+try:
+    import fcntl
+
+except ImportError:
+    fcntl = None
+
+from . import rcon, encoding
 from nova.internal.building import NovaBuilder
 
+# Copying methods
+FICLONE = 0x40049409  # Linux ioctl for copy-on-write clones (btrfs, xfs, bcachefs, ...)
+
+def copy_file(source: Path, destination: Path, method: str) -> None:
+    if method == "hardlink":
+        try:
+            return os.link(source, destination)
+
+        except OSError:
+            pass
+
+    elif method == "reflink" and fcntl is not None:
+        try:
+            with source.open("rb") as source_file, destination.open("wb") as destination_file:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+
+            return shutil.copymode(source, destination)
+
+        except OSError:
+            destination.unlink(missing_ok = True)
+
+    shutil.copy(source, destination)
+
 # Handle plugin
 class StaticPlugin:
     def __init__(self, builder: NovaBuilder, config: dict) -> None:
-        self.source, self.destination = \
-            builder.source / "static", builder.destination
+        self.builder, self.source, self.destination = \
+            builder, builder.source / "static", builder.destination
+
+        self.method = config.get("method", "reflink")
+        if self.method not in ("copy", "reflink", "hardlink"):
+            rcon.print(f"[yellow]\u26a0  Static copy method unknown: '{self.method}', falling back to copying.[/]")
+            self.method = "copy"
+
+        # Keep track of what was last synced
+        self.manifest_location = builder.cache / "static.json" if builder.cache is not None else None
+        self.manifest = {}
+        if self.manifest_location is not None and self.manifest_location.is_file():
+            self.manifest = json.loads(self.manifest_location.read_text(encoding))
 
         # Hooks
+        self.links = set()
         atexit.register(self.ensure_symlink_removal)
 
     def remove(self, path: Path) -> None:
@@ -28,19 +72,28 @@ class StaticPlugin:
         if not self.source.is_dir():
             return
 
-        for file in self.source.rglob("*"):
-            if not file.is_file():
-                continue
+        # While developing, only the files the watcher saw need relinking
+        if dev and self.builder.changes is not None:
+            files = [file for file in self.builder.changes if file.is_relative_to(self.source)]
+
+        else:
+            files = self.source.rglob("*")
 
+        synced = set()
+        for file in files:
             destination = self.destination / file.relative_to(self.source)
             if not file.exists():
                 self.remove(destination)
                 continue
 
+            if not file.is_file():
+                continue
+
             if not destination.parent.is_dir():
                 destination.parent.mkdir(parents = True)
 
             if dev:
+                self.links.add(destination)
                 if destination.is_symlink():
                     continue
 
@@ -50,16 +103,57 @@ class StaticPlugin:
                 os.symlink(file, destination)
 
             else:
-                if destination.exists():
+                relative_location, stat = file.relative_to(self.source).as_posix(), file.stat()
+                synced.add(relative_location)
+
+                # Never write through a link, it would end up changing the source file
+                if self.builder.has_stages(destination):
+                    if destination.is_symlink() or (destination.is_file() and destination.stat().st_nlink > 1):
+                        self.remove(destination)
+
+                    self.builder.process(destination, file.read_text(encoding), dev)
+                    self.manifest[relative_location] = [stat.st_size, stat.st_mtime_ns, None]
+                    continue
+
+                if self.is_synced(relative_location, file, stat, destination):
+                    continue
+
+                if destination.exists() or destination.is_symlink():
                     self.remove(destination)
 
-                (shutil.copytree if file.is_dir() else shutil.copy)(file, destination)
+                copy_file(file, destination, self.method)
+
+        # Clean up after anything that was removed from the source
+        if not dev:
+            for relative_location in set(self.manifest) - synced:
+                self.builder.remove(self.destination / relative_location)
+                del self.manifest[relative_location]
+
+            if self.manifest_location is not None:
+                self.manifest_location.parent.mkdir(parents = True, exist_ok = True)
+                self.manifest_location.write_text(json.dumps(self.manifest), encoding)
+
+    def is_synced(self, relative_location: str, file: Path, stat: os.stat_result, destination: Path) -> bool:
+        known = self.manifest.get(relative_location)
+        synced = known is not None and known[0] == stat.st_size and destination.is_file() and \
+            not destination.is_symlink() and destination.stat().st_size == stat.st_size
+        if synced and known[1] == stat.st_mtime_ns:
+            return True
+
+        # Only the timestamp moved (ie. a git checkout), the contents decide
+        digest = hashlib.sha1(file.read_bytes()).hexdigest() if synced else None
+        self.manifest[relative_location] = [stat.st_size, stat.st_mtime_ns, digest]
+        return synced and digest == known[2]  # type: ignore
 
     def ensure_symlink_removal(self) -> None:
-        for file in self.destination.rglob("*"):
-            if file.is_symlink():
-                self.remove(file)
+        if not self.links:
+            return
+
+        for link in self.links:
+            if link.is_symlink():
+                link.unlink()
 
-        for file in self.destination.rglob("*"):
-            if file.is_dir() and not any([x.is_file() for x in file.rglob("*")]):
-                shutil.rmtree(file)
+        # Children come before their parents, so nested empty directories go in one pass
+        for root, _, _ in os.walk(self.destination, topdown = False):
+            if root != str(self.destination) and not os.listdir(root):
+                os.rmdir(root)
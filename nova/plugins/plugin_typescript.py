@@ -1,9 +1,11 @@
 # Copyright (c) 2024 iiPython
 
 # Modules
+import json
+import hashlib
 import subprocess
 
-from . import StaticFileBasedBuilder
+from . import StaticFileBasedBuilder, encoding
 
 # Handle plugin
 class TypescriptPlugin(StaticFileBasedBuilder):
@@ -16,15 +18,41 @@ class TypescriptPlugin(StaticFileBasedBuilder):
             *args
         )
 
+        # Keep track of what was last compiled successfully
+        self.manifest_location = self.builder.cache / "typescript.json" if self.builder.cache is not None else None
+        self.manifest = {}
+        if self.manifest_location is not None and self.manifest_location.is_file():
+            self.manifest = json.loads(self.manifest_location.read_text(encoding))
+
     def on_build(self, dev: bool) -> None:
-        for file in self.source.rglob("*"):
-            if not file.is_file():
-                continue
-
-            subprocess.run([
-                self.build_binary,
-                "compile",
-                file,
-                "--out-file",
-                self.destination / file.with_suffix(".js").relative_to(self.source)
-            ])
+        if dev and self.builder.changes is not None:
+            files = [file for file in self.builder.changes if file.is_relative_to(self.source) and file.is_file()]
+
+        else:
+            files = [file for file in self.source.rglob("*") if file.is_file()]
+
+        # Skip anything that hasn't changed since it was last compiled
+        pending = {}
+        for file in files:
+            relative_location = str(file.relative_to(self.source))
+            digest = hashlib.sha1(file.read_bytes()).hexdigest()
+            if self.manifest.get(relative_location) != digest or \
+                not (self.destination / file.relative_to(self.source).with_suffix(".js")).is_file():
+                pending[relative_location] = digest
+
+        if not pending:
+            return
+
+        result = subprocess.run([
+            self.build_binary,
+            "compile",
+            *pending,
+            "--out-dir",
+            self.destination
+        ], cwd = self.source)
+        if result.returncode != 0:
+            return
+
+        self.manifest |= pending
+        if self.manifest_location is not None:
+            self.manifest_location.write_text(json.dumps(self.manifest), encoding)